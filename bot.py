@@ -19,7 +19,8 @@ logger.add(
     format=default_format,
     rotation="1 week",  # 每周轮转一次
     retention="1 month",  # 保留一个月
-    encoding="utf-8"
+    encoding="utf-8",
+    enqueue=True  # 由后台线程写文件, 不阻塞事件循环
 )
 
 logger.add(
@@ -28,7 +29,8 @@ logger.add(
     format=default_format,
     rotation="1 day",  # 每天轮转一次
     retention="7 days",  # 保留7天
-    encoding="utf-8"
+    encoding="utf-8",
+    enqueue=True  # 由后台线程写文件, 不阻塞事件循环
 )
 
 # 初始化 NoneBot
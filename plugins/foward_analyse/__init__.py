@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-私聊消息日志插件
-监听特定用户的私聊消息并在控制台打印
+合并转发消息分析插件
+白名单用户回复合并转发消息并发送 ana 命令, 调用 LLM 对对话进行分析
 """
 from nonebot import require, get_driver, logger
-from nonebot.adapters.onebot.v11 import Bot, PrivateMessageEvent, GroupMessageEvent, MessageSegment
-from openai import OpenAI
+from nonebot.adapters.onebot.v11 import Bot, PrivateMessageEvent, GroupMessageEvent, Message, MessageSegment
+import asyncio
+import hashlib
 import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from functools import cache
 from pathlib import Path
 from typing import Optional
 from pydantic import BaseModel, Field
@@ -16,21 +22,22 @@ from nonebot.params import Command
 from typing import Annotated
 
 require("nonebot_plugin_htmlkit")
-from nonebot_plugin_htmlkit import md_to_pic, html_to_pic
+from nonebot_plugin_htmlkit import md_to_pic
 
 # 导入 prompts 模块
+from . import prompts
 from .prompts import (
     PLUGIN_DIR,
-    PROMPT_ALIAS_MAP,
     SYSTEM_PROMPT_ANA_PATH,
     EMPTY_CSS_PATH,
-    parse_yaml_front_matter,
-    load_prompt_aliases,
-    load_prompt_content
+    refresh_aliases,
+    load_prompt_content_async,
+    list_prompt_files,
+    read_prompt_file
 )
 
 # 导入 cmd_ana 模块
-from .cmd_ana import commandToPromptFilePath, create_forward_ana_cmd
+from .cmd_ana import commandToPromptFilePath, COMMAND_ALIASES_STR, create_forward_ana_cmd
 
 # 定义插件配置模型
 class PluginConfig(BaseModel):
@@ -60,175 +67,502 @@ class PluginConfig(BaseModel):
         alias="OPENAI_MODEL",
         description="OpenAI 模型名称"
     )
+    openai_timeout: float = Field(
+        default=60,
+        alias="OPENAI_TIMEOUT",
+        description="OpenAI 请求超时时间(秒)"
+    )
+    openai_max_retries: int = Field(
+        default=2,
+        alias="OPENAI_MAX_RETRIES",
+        description="OpenAI 请求失败时的最大重试次数"
+    )
+    ana_concurrency: int = Field(
+        default=4,
+        ge=1,
+        alias="ANA_CONCURRENCY",
+        description="同时进行 LLM 调用和图片渲染的 ana 请求数上限"
+    )
+    ana_prompts_text_threshold: int = Field(
+        default=4000,
+        alias="ANA_PROMPTS_TEXT_THRESHOLD",
+        description="--prompts 内容短于该长度时直接以文本发送, 不渲染图片"
+    )
+    ana_llm_cache: bool = Field(
+        default=True,
+        alias="ANA_LLM_CACHE",
+        description="是否缓存 LLM 结果, 相同的提示词和对话内容直接返回缓存"
+    )
+    ana_llm_cache_ttl: int = Field(
+        default=7 * 24 * 3600,
+        ge=1,
+        alias="ANA_LLM_CACHE_TTL",
+        description="LLM 结果缓存的有效期(秒), 过期后重新调用 LLM"
+    )
+
+
+@cache
+def load_plugin_config() -> PluginConfig:
+    """从 driver 配置对象直接按属性校验插件配置, 只解析一次"""
+    return PluginConfig.model_validate(get_driver().config, from_attributes=True, by_alias=False, by_name=True)
+
 
 # 获取插件配置
-driver = get_driver()
-plugin_config = PluginConfig.model_validate(driver.config.model_dump(), extra="allow", by_alias=False, by_name=True)
+plugin_config = load_plugin_config()
+
+# 使用配置中的白名单, 转换为 frozenset 以便 O(1) 判断
+ANA_USER_ID_ALLOW_LIST: frozenset[int] = frozenset(plugin_config.ana_user_id_allow_list)
+ANA_GROUP_ID_ALLOW_LIST: frozenset[int] = frozenset(plugin_config.ana_group_id_allow_list)
 
-# 使用配置中的白名单，并转换为字符串列表
-ANA_USER_ID_ALLOW_LIST = [str(uid) for uid in plugin_config.ana_user_id_allow_list]
-ANA_GROUP_ID_ALLOW_LIST = [str(gid) for gid in plugin_config.ana_group_id_allow_list]
+# 支持的消息事件类型
+_PRIV_OR_GROUP = (PrivateMessageEvent, GroupMessageEvent)
 
 
-def check_user_permission(event) -> bool:
-    """检查用户是否在白名单中"""
+async def check_user_permission(event) -> bool:
+    """
+    检查用户是否在白名单中
+    作为命令的 permission 使用, 在 rule 之前执行; 定义为协程可避免 nonebot 把同步函数放入线程池执行
+    """
+    # 如果两个白名单都为空，拒绝所有请求
+    if not (ANA_USER_ID_ALLOW_LIST or ANA_GROUP_ID_ALLOW_LIST):
+        return False
+
     # 同时支持私聊和群聊
-    if isinstance(event, (PrivateMessageEvent, GroupMessageEvent)):
-        user_id = str(event.user_id)
-        
-        # 检查用户ID白名单
-        if ANA_USER_ID_ALLOW_LIST and user_id in ANA_USER_ID_ALLOW_LIST:
-            return True
-        
-        # 检查群组ID白名单（仅对群消息）
-        if isinstance(event, GroupMessageEvent):
-            group_id = str(event.group_id)
-            if ANA_GROUP_ID_ALLOW_LIST and group_id in ANA_GROUP_ID_ALLOW_LIST:
-                return True
-        
-        # 如果两个白名单都为空，拒绝所有请求
-        if not ANA_USER_ID_ALLOW_LIST and not ANA_GROUP_ID_ALLOW_LIST:
-            return False
-            
+    if not isinstance(event, _PRIV_OR_GROUP):
         return False
-    return False
+
+    # 检查用户ID白名单
+    if event.user_id in ANA_USER_ID_ALLOW_LIST:
+        return True
+
+    # 检查群组ID白名单（仅对群消息）
+    return isinstance(event, GroupMessageEvent) and event.group_id in ANA_GROUP_ID_ALLOW_LIST
+
+
+# 日志分隔线
+_SEP = "=" * 50
+_CHAT_SEP = "=" * 25 + "对话内容" + "=" * 25
+
+# 固定的回复文本, 在加载插件时构建一次
+_TIP_NEED_FORWARD = MessageSegment.text("请回复一条合并转发的消息\n如果超过100条 可以嵌套合并转发")
+_TIP_HELP_FAILED = MessageSegment.text("读取帮助文件失败")
+_TIP_NO_PROMPTS = MessageSegment.text("未找到任何 prompt 文件")
+_TIP_LLM_FAILED = MessageSegment.text("调用 LLM 时发生错误!")
+
+# --prompt=xxx 中允许的 prompt 名称
+_PROMPT_NAME_RE = re.compile(r"[\w\-\.]+")
+
+
+def parse_flags(message_text: str) -> dict:
+    """
+    按空白切分消息, 一次扫描解析出所有 --xxx / --xxx=yyy 参数
+    返回: {参数名: 值}, 无值的参数值为 True
+    """
+    flags = {}
+    for token in message_text.split():
+        if not token.startswith("--"):
+            continue
+        name, sep, value = token[2:].partition("=")
+        if not sep:
+            flags[name] = True
+        elif name != "prompt" or _PROMPT_NAME_RE.fullmatch(value):
+            flags[name] = value
+    return flags
+
+
+# 全局复用的 LLM 客户端, 首次调用时创建
+_llm_client = None
+
+if not plugin_config.openai_api_key:
+    logger.warning("未配置 OPENAI_API_KEY, ana 命令将无法调用 LLM")
+
+
+def get_llm_client():
+    """获取 AsyncOpenAI 客户端单例, 复用其连接池"""
+    global _llm_client
+    if _llm_client is None:
+        if not plugin_config.openai_api_key:
+            raise RuntimeError("未配置 OPENAI_API_KEY, 无法调用 LLM")
+        # 延迟导入 openai, 避免未使用 ana 功能时拖慢启动
+        from openai import AsyncOpenAI
+        _llm_client = AsyncOpenAI(
+            api_key=plugin_config.openai_api_key,
+            base_url=plugin_config.openai_api_base,
+            max_retries=plugin_config.openai_max_retries,
+            timeout=plugin_config.openai_timeout
+        )
+    return _llm_client
+
+
+async def request_llm(system_prompt: str, usersChatText: str) -> str:
+    """以流式方式调用 LLM, 边接收边拼接, 返回完整回复; 受 ANA_CONCURRENCY 限制"""
+    async with get_ana_semaphore():
+        stream = await get_llm_client().chat.completions.create(
+            model=plugin_config.openai_model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": usersChatText}
+            ],
+            stream=True
+        )
+
+        parts = []
+        async for chunk in stream:
+            # 部分服务会发送不含 choices 的 chunk (如 usage 统计)
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+    return "".join(parts)
+
+
+# 同时进行的 LLM 调用和结果图片渲染上限, 首次使用时创建
+# 命中缓存的请求和等待提示的发送不占用名额
+# Python 3.9 的 asyncio.Semaphore 会绑定创建时的事件循环, 不能在导入插件时创建
+_ana_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def get_ana_semaphore() -> asyncio.Semaphore:
+    """获取限制 ana 并发数的信号量, 在 nonebot 的事件循环中创建"""
+    global _ana_semaphore
+    if _ana_semaphore is None:
+        _ana_semaphore = asyncio.Semaphore(plugin_config.ana_concurrency)
+    return _ana_semaphore
+
+
+# LLM 结果缓存目录, 每个结果保存为一个 json 文件, 最多保留 _LLM_CACHE_DIR_SIZE 个
+LLM_CACHE_DIR = PLUGIN_DIR / ".cache"
+_LLM_CACHE_DIR_SIZE = 512
+
+
+def _write_cache_file(path: Path, data: bytes):
+    """先写入同目录下的临时文件再替换, 避免并发读取时读到写了一半的缓存"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+def _llm_cache_path(system_prompt: str, usersChatText: str) -> Path:
+    """根据模型、系统提示词和对话内容计算缓存文件路径"""
+    key = hashlib.sha256(f"{plugin_config.openai_model}\x00{system_prompt}\x00{usersChatText}".encode()).hexdigest()
+    return LLM_CACHE_DIR / f"{key}.json"
+
+
+def _load_llm_cache(cache_path: Path) -> Optional[str]:
+    """读取缓存的 LLM 结果, 不存在、已过期或损坏时返回 None"""
+    try:
+        data = json.loads(cache_path.read_text(encoding="utf-8"))
+        if time.time() - data["ts"] > plugin_config.ana_llm_cache_ttl:
+            cache_path.unlink(missing_ok=True)
+            return None
+        return data["result"]
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.opt(exception=True).warning(f"读取 LLM 缓存失败 ({cache_path.name}): {e}")
+        return None
+
+
+def _save_llm_cache(cache_path: Path, llm_result: str):
+    """保存 LLM 结果到缓存"""
+    try:
+        _write_cache_file(cache_path, json.dumps({"result": llm_result, "ts": time.time()}, ensure_ascii=False).encode("utf-8"))
+    except Exception as e:
+        logger.opt(exception=True).warning(f"写入 LLM 缓存失败 ({cache_path.name}): {e}")
+        return
+    _prune_cache_dir(cache_path.parent, "*.json", _LLM_CACHE_DIR_SIZE)
+
+
+async def get_llm_result(system_prompt: str, usersChatText: str, use_cache: bool = True) -> str:
+    """
+    获取 LLM 结果, 命中缓存时不再调用 LLM
+    use_cache 为 False 时 (--no-cache) 跳过读取缓存, 重新调用 LLM 并用新结果更新缓存
+    """
+    if not plugin_config.ana_llm_cache:
+        return await request_llm(system_prompt, usersChatText)
+
+    cache_path = _llm_cache_path(system_prompt, usersChatText)
+    if use_cache:
+        llm_result = await asyncio.to_thread(_load_llm_cache, cache_path)
+        if llm_result is not None:
+            logger.info(f"命中 LLM 缓存: {cache_path.name}")
+            return llm_result
+
+    llm_result = await request_llm(system_prompt, usersChatText)
+    # 空回复 (如被过滤或截断) 不写入缓存, 避免之后一直返回同样的空结果
+    if llm_result.strip():
+        await asyncio.to_thread(_save_llm_cache, cache_path, llm_result)
+    return llm_result
+
+
+# 帮助文件: 加载插件时读入, 之后仅在 mtime 变化时重新读取
+HELP_MD_PATH = PLUGIN_DIR / "help.md"
+_help_md_cache: Optional[tuple[float, str]] = None
+
+
+def load_help_md() -> str:
+    """读取帮助文件, mtime 未变化时直接返回缓存"""
+    global _help_md_cache
+    mtime = HELP_MD_PATH.stat().st_mtime
+    if _help_md_cache and _help_md_cache[0] == mtime:
+        return _help_md_cache[1]
+
+    help_md = HELP_MD_PATH.read_text(encoding="utf-8")
+    _help_md_cache = (mtime, help_md)
+    return help_md
 
 
-# 创建命令处理器,响应白名单用户的私聊和群聊消息
+try:
+    load_help_md()
+except Exception as e:
+    logger.opt(exception=True).warning(f"预读取帮助文件失败: {e}")
+
+
+# 渲染结果缓存: 内容哈希 -> 图片, 最多保留 _PIC_CACHE_SIZE 张
+# 只用于帮助、prompt 列表、系统提示词等会重复渲染的内容, LLM 结果图片不放入内存
+_PIC_CACHE: "OrderedDict[bytes, bytes]" = OrderedDict()
+_PIC_CACHE_SIZE = 64
+
+# LLM 结果图片的磁盘缓存, 仅在开启 ANA_LLM_CACHE 时使用, 最多保留 _PIC_CACHE_DIR_SIZE 张
+PIC_CACHE_DIR = LLM_CACHE_DIR / "img"
+_PIC_CACHE_DIR_SIZE = 128
+
+
+def _pic_cache_key(md: str, kwargs: dict) -> bytes:
+    """根据 markdown 内容和渲染参数计算缓存键"""
+    return hashlib.blake2b(md.encode() + repr(sorted(kwargs.items())).encode(), digest_size=16).digest()
+
+
+def _prune_cache_dir(cache_dir: Path, pattern: str, max_files: int):
+    """只保留 cache_dir 中最近写入的 max_files 个缓存文件, 其余删除"""
+    try:
+        files = sorted(cache_dir.glob(pattern), key=lambda f: f.stat().st_mtime, reverse=True)
+        for f in files[max_files:]:
+            f.unlink(missing_ok=True)
+    except Exception as e:
+        logger.opt(exception=True).warning(f"清理缓存目录失败 ({cache_dir}): {e}")
+
+
+def _load_pic_cache(pic_path: Path) -> Optional[bytes]:
+    """读取磁盘上缓存的图片, 不存在时返回 None"""
+    try:
+        return pic_path.read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+def _save_pic_cache(pic_path: Path, pic: bytes):
+    """保存图片到磁盘缓存, 并清理超出数量上限的旧图片"""
+    try:
+        _write_cache_file(pic_path, pic)
+    except Exception as e:
+        logger.opt(exception=True).warning(f"写入图片缓存失败 ({pic_path.name}): {e}")
+        return
+    _prune_cache_dir(pic_path.parent, "*.png", _PIC_CACHE_DIR_SIZE)
+
+
+async def cached_md_to_pic(md: str, **kwargs) -> bytes:
+    """带 LRU 缓存的 md_to_pic, 适用于帮助、prompt 预览等内容不常变化的图片"""
+    key = _pic_cache_key(md, kwargs)
+    pic = _PIC_CACHE.get(key)
+    if pic is not None:
+        _PIC_CACHE.move_to_end(key)
+        return pic
+
+    pic = await md_to_pic(md=md, **kwargs)
+    _PIC_CACHE[key] = pic
+    if len(_PIC_CACHE) > _PIC_CACHE_SIZE:
+        _PIC_CACHE.popitem(last=False)
+    return pic
+
+
+async def render_llm_result(md: str, **kwargs) -> bytes:
+    """
+    渲染 LLM 结果图片, 实际渲染时受 ANA_CONCURRENCY 限制
+    开启 LLM 缓存时同时读写磁盘缓存, 关闭时不落盘
+    """
+    if not plugin_config.ana_llm_cache:
+        async with get_ana_semaphore():
+            return await md_to_pic(md=md, **kwargs)
+
+    pic_path = PIC_CACHE_DIR / f"{_pic_cache_key(md, kwargs).hex()}.png"
+    pic = await asyncio.to_thread(_load_pic_cache, pic_path)
+    if pic is None:
+        async with get_ana_semaphore():
+            pic = await md_to_pic(md=md, **kwargs)
+        await asyncio.to_thread(_save_pic_cache, pic_path, pic)
+    return pic
+
+
+# 创建命令处理器,响应白名单用户的私聊和群聊消息 (白名单作为 permission 检查)
 forward_ana_cmd = create_forward_ana_cmd(check_user_permission, plugin_config)
 
+
+# 每个会话中每个用户最近一次展示过的系统提示词: (user_id, group_id) -> (提示词哈希, 展示时间)
+# 私聊的 group_id 为 None; 在 _PREVIEW_SKIP_SECONDS 内重复使用相同提示词时, 不再重复渲染图片
+# 按展示时间排序, 写入时从头部清理已过期的记录
+_LAST_PREVIEW: "OrderedDict[tuple[int, Optional[int]], tuple[int, float]]" = OrderedDict()
+_PREVIEW_SKIP_SECONDS = 10 * 60
+
+
+async def send_prompt_preview(event, system_prompt: str, prompt_filename: str):
+    """发送 LLM 等待提示和系统提示词图片, 出错时只记录日志, 不影响 LLM 调用"""
+    try:
+        segments = [MessageSegment.reply(event.message_id)]
+        prompt_hash = hash(system_prompt)
+        now = time.monotonic()
+        preview_key = (event.user_id, getattr(event, "group_id", None))
+        last = _LAST_PREVIEW.get(preview_key)
+        if last and last[0] == prompt_hash and now - last[1] < _PREVIEW_SKIP_SECONDS:
+            segments.append(MessageSegment.text(f"LLM中, 请稍候\n(如果生成失败也会有回复)\n\n使用的系统提示词 ({prompt_filename}) 与上次相同"))
+            await forward_ana_cmd.send(message=Message(segments))
+            return
+
+        segments.append(MessageSegment.text(f"LLM中, 请稍候\n(如果生成失败也会有回复)\n\n使用的系统提示词 ({prompt_filename}):\n"))
+        try:
+            # 将系统提示词转换为图片
+            prompt_pic = await cached_md_to_pic(md=system_prompt, max_width=900, dpi=220, allow_refit=False, css_path=EMPTY_CSS_PATH)
+            segments.append(MessageSegment.image(prompt_pic))
+            _LAST_PREVIEW.pop(preview_key, None)
+            _LAST_PREVIEW[preview_key] = (prompt_hash, now)
+            while now - next(iter(_LAST_PREVIEW.values()))[1] >= _PREVIEW_SKIP_SECONDS:
+                _LAST_PREVIEW.popitem(last=False)
+        except Exception as prompt_pic_error:
+            logger.opt(exception=True).error(f"生成系统提示词图片时发生错误: {prompt_pic_error}")
+        await forward_ana_cmd.send(message=Message(segments))
+    except Exception as e:
+        logger.opt(exception=True).error(f"发送系统提示词时发生错误: {e}")
+
+
 @forward_ana_cmd.handle()
 async def handle_ana_command(bot: Bot, event, command: Annotated[tuple[str, ...], Command()]):
     """处理ana命令"""
-    logger.info("=" * 50)
+    logger.info(_SEP)
 
     trigger = command[0]
 
-    user_id = event.user_id
-    message_id = event.message_id
-    
-    # 判断消息来源
-    is_group = isinstance(event, GroupMessageEvent)
-    if is_group:
-        logger.info(f"收到来自群 {event.group_id} 中用户 {user_id} 的ana请求")
+    # 判断消息来源, 合并为一条日志
+    if isinstance(event, GroupMessageEvent):
+        logger.info(f"收到来自群 {event.group_id} 中用户 {event.user_id} 的ana请求, 消息ID: {event.message_id}")
     else:
-        logger.info(f"收到来自用户 {user_id} 的ana请求")
-    
-    logger.info(f"消息ID: {message_id}")
+        logger.info(f"收到来自用户 {event.user_id} 的ana请求, 消息ID: {event.message_id}")
     
     try:
         # 检查是否包含 --help 参数
         message_text = event.get_plaintext().strip()
-        if "--help" in message_text:
+        flags = parse_flags(message_text)
+        if "help" in flags:
             logger.info("检测到 --help 参数，显示帮助信息")
             try:
-                # 获取所有可用的命令别名
-                from .cmd_ana import get_all_aliases
-                all_aliases = get_all_aliases()
-                aliases_str = ", ".join(sorted(all_aliases))
-                
-                # 读取帮助文件
-                help_file_path = PLUGIN_DIR / "help.md"
-                with open(help_file_path, "r", encoding="utf-8") as f:
-                    help_md = f.read()
+                # 读取帮助文件 (已在加载插件时读入, 仅在文件修改后重新读取)
+                help_md = await asyncio.to_thread(load_help_md)
                 
                 # 在最上面添加可用命令前缀
-                help_content = f"**可用命令前缀**: {aliases_str}\n\n---\n\n{help_md}"
+                help_content = f"**可用命令前缀**: {COMMAND_ALIASES_STR}\n\n---\n\n{help_md}"
                 
                 # 使用图片形式渲染md回复
-                message = MessageSegment.reply(event.message_id)
+                segments = [MessageSegment.reply(event.message_id)]
                 try:
-                    help_pic = await md_to_pic(md=help_content, max_width=900, dpi=220, allow_refit=False, css_path=EMPTY_CSS_PATH)
-                    message += MessageSegment.image(help_pic)
+                    help_pic = await cached_md_to_pic(md=help_content, max_width=900, dpi=220, allow_refit=False, css_path=EMPTY_CSS_PATH)
+                    segments.append(MessageSegment.image(help_pic))
                 except Exception as pic_error:
                     logger.opt(exception=True).error(f"生成帮助图片时发生错误: {pic_error}")
-                    message += MessageSegment.text(help_content)
+                    segments.append(MessageSegment.text(help_content))
                 
-                await forward_ana_cmd.send(message=message)
+                await forward_ana_cmd.send(message=Message(segments))
             except Exception as help_error:
                 logger.opt(exception=True).error(f"读取帮助文件时发生错误: {help_error}")
-                message = MessageSegment.reply(event.message_id)
-                message += MessageSegment.text("读取帮助文件失败")
-                await forward_ana_cmd.send(message=message)
-            logger.info("=" * 50)
+                await forward_ana_cmd.send(message=Message([
+                    MessageSegment.reply(event.message_id),
+                    _TIP_HELP_FAILED
+                ]))
             return
         
         # 检查是否包含 --prompts 或 --prompt=xxx 参数
-        if "--prompts" in message_text:
+        if "prompts" in flags:
             logger.info("检测到 --prompts 参数，刷新并读取所有 prompt 文件")
             
             # 刷新 alias 映射
-            from . import prompts
-            prompts.PROMPT_ALIAS_MAP = load_prompt_aliases()
+            await asyncio.to_thread(refresh_aliases)
 
             try:
-                prompts_dir = PLUGIN_DIR / "prompts"
-                md_files = sorted(prompts_dir.glob("*.md"))
+                md_files = await asyncio.to_thread(list_prompt_files)
                 if not md_files:
-                    message = MessageSegment.reply(event.message_id)
-                    message += MessageSegment.text("未找到任何 prompt 文件")
-                    await forward_ana_cmd.send(message=message)
+                    await forward_ana_cmd.send(message=Message([
+                        MessageSegment.reply(event.message_id),
+                        _TIP_NO_PROMPTS
+                    ]))
                     return
                 combined_md = []
-                
-                for md_file in md_files:
-                    try:
-                        with open(md_file, "r", encoding="utf-8") as f:
-                            content = f.read()
-                        
+
+                # 并发读取所有 prompt 文件
+                contents = await asyncio.gather(
+                    *(asyncio.to_thread(read_prompt_file, md_file) for md_file in md_files),
+                    return_exceptions=True
+                )
+                for md_file, content in zip(md_files, contents):
+                    if isinstance(content, Exception):
+                        logger.opt(exception=content).error(f"读取文件 {md_file.name} 失败: {content}")
+                        combined_md.append(f"## {md_file.name}\n\n读取失败: {content}")
+                    else:
                         # 为每个文件添加标题、别名和内容
                         combined_md.append(f"# {md_file.name}\n\n{content}")
-                    except Exception as e:
-                        logger.opt(exception=True).error(f"读取文件 {md_file.name} 失败: {e}")
-                        combined_md.append(f"## {md_file.name}\n\n读取失败: {e}")
                 final_md = "\n\n---\n\n".join(combined_md)
-                message = MessageSegment.reply(event.message_id)
-                message += MessageSegment.text(f"找到 {len(md_files)} 个 prompt 文件:\n")
-                try:
-                    pic = await md_to_pic(md=final_md, max_width=900, dpi=220, allow_refit=False, css_path=EMPTY_CSS_PATH)
-                    
-                    message += MessageSegment.image(pic)
-                except Exception as pic_error:
-                    logger.opt(exception=True).error(f"生成图片时发生错误: {pic_error}")
-                    message += MessageSegment.text(f"但生成图片失败\n\n{final_md[:500]}...")
-                await forward_ana_cmd.send(message=message)
+                segments = [MessageSegment.reply(event.message_id), MessageSegment.text(f"找到 {len(md_files)} 个 prompt 文件:\n")]
+                if len(final_md) < plugin_config.ana_prompts_text_threshold:
+                    # 内容较短时直接发送文本, 不渲染图片
+                    segments.append(MessageSegment.text(final_md))
+                else:
+                    try:
+                        pic = await cached_md_to_pic(md=final_md, max_width=900, dpi=220, allow_refit=False, css_path=EMPTY_CSS_PATH)
+
+                        segments.append(MessageSegment.image(pic))
+                    except Exception as pic_error:
+                        logger.opt(exception=True).error(f"生成图片时发生错误: {pic_error}")
+                        segments.append(MessageSegment.text(f"但生成图片失败\n\n{final_md[:500]}..."))
+                await forward_ana_cmd.send(message=Message(segments))
             except Exception as e:
                 logger.opt(exception=True).error(f"处理 --prompts 参数时发生错误: {e}")
-                message = MessageSegment.reply(event.message_id)
-                message += MessageSegment.text(f"处理失败: {e}")
-                await forward_ana_cmd.send(message=message)
-            logger.info("=" * 50)
+                await forward_ana_cmd.send(message=Message([
+                    MessageSegment.reply(event.message_id),
+                    MessageSegment.text(f"处理失败: {e}")
+                ]))
+            return
+
+        # 未回复合并转发消息时尽早返回, 不再解析 prompt
+        reply = getattr(event, "reply", None)
+        reply_first = reply.message[0] if (reply and reply.message) else None
+        if reply_first is None or reply_first.type != "forward":
+            await forward_ana_cmd.send(message=Message([
+                MessageSegment.reply(event.message_id),
+                _TIP_NEED_FORWARD
+            ]))
             return
 
         # 检查 --prompt=xxx 参数
-        prompt_match = re.search(r"--prompt=([\w\-\.]+)", message_text)
+        prompt_name = flags.get("prompt")
         custom_prompt_path = None
-        if prompt_match:
-            prompt_name = prompt_match.group(1)
+        if prompt_name:
             # 从 prompts 模块的 alias map 中查找路径
-            from . import prompts
-            if prompt_name in prompts.PROMPT_ALIAS_MAP:
-                custom_prompt_path = Path(prompts.PROMPT_ALIAS_MAP[prompt_name])
+            # alias map 已包含带/不带 .md 后缀的文件名, 不再直接拼接路径, 避免访问 prompts 目录以外的文件
+            custom_prompt_path = prompts.PROMPT_ALIAS_MAP.get(prompt_name)
+            if custom_prompt_path is None:
+                # 可能是新增的 prompt 文件, 重新扫描一次
+                custom_prompt_path = (await asyncio.to_thread(refresh_aliases)).get(prompt_name)
+            if custom_prompt_path is not None:
                 logger.info(f"通过 alias '{prompt_name}' 找到 prompt 文件: {custom_prompt_path.name}")
             else:
-                # 兼容旧的逻辑,自动补全 .md 后缀
-                if not prompt_name.endswith(".md"):
-                    prompt_name += ".md"
-                custom_prompt_path = PLUGIN_DIR / "prompts" / prompt_name
-                logger.warning(f"在 alias map 中未找到 '{prompt_name}', 尝试直接拼接路径: {custom_prompt_path}")
-
-        if not (hasattr(event, 'reply') and event.reply
-                and len(event.reply.message) > 0 and event.reply.message[0].type == "forward"):
-            message = MessageSegment.reply(event.message_id)
-            message += MessageSegment.text("请回复一条合并转发的消息\n如果超过100条 可以嵌套合并转发")
-            await forward_ana_cmd.send(message=message)
-            return
+                logger.warning(f"未找到 prompt '{prompt_name}', 使用命令对应的 prompt")
 
         # --- 决定并加载 system prompt ---
         # 优先使用 --prompt 参数指定的 prompt
         # 否则根据触发命令从 commandToPromptFilePath 中获取对应的 prompt
         prompt_to_use_path = None
-        if custom_prompt_path and custom_prompt_path.exists():
+        if custom_prompt_path:
             prompt_to_use_path = custom_prompt_path
         elif trigger in commandToPromptFilePath:
             prompt_to_use_path = commandToPromptFilePath[trigger]
@@ -237,85 +571,85 @@ async def handle_ana_command(bot: Bot, event, command: Annotated[tuple[str, ...]
             prompt_to_use_path = SYSTEM_PROMPT_ANA_PATH
             logger.warning(f"触发命令 '{trigger}' 未在 commandToPromptFilePath 中找到,使用默认 prompt")
 
-        system_prompt = load_prompt_content(prompt_to_use_path)
+        system_prompt = await load_prompt_content_async(prompt_to_use_path)
         
         # 检查是否有 --short 参数，如果有则添加简短回复提示
-        if "--short" in message_text:
+        if "short" in flags:
             system_prompt += "\n⭐⭐**请用较短的篇幅回复**⭐⭐"
             logger.info("检测到 --short 参数，已添加简短回复提示")
         
         prompt_filename = prompt_to_use_path.name
         logger.info(f"使用 prompt 文件: {prompt_filename}")
 
-        message = MessageSegment.reply(event.message_id)
-        message += MessageSegment.text(f"LLM中, 请稍候\n(如果生成失败也会有回复)\n\n使用的系统提示词 ({prompt_filename}):\n")
-        # 先发送提示消息和系统提示词图片
-        try:
-            # 将系统提示词转换为图片
-            prompt_pic = await md_to_pic(md=system_prompt, max_width=900, dpi=220, allow_refit=False, css_path=EMPTY_CSS_PATH)
-            message += MessageSegment.image(prompt_pic)
-        except Exception as prompt_pic_error:
-            logger.opt(exception=True).error(f"生成系统提示词图片时发生错误: {prompt_pic_error}")
-        await forward_ana_cmd.send(message=message)
+        forward_content = reply_first.data.get("content")
+        usersChatText = messageToSimple(forward_content)
+        # 完整对话内容只在 DEBUG 级别输出, 避免每次请求写入大量日志
+        logger.info(f"对话内容长度: {len(usersChatText)}")
+        logger.debug(_CHAT_SEP)
+        logger.debug(usersChatText)
+        logger.debug(_SEP)
 
-        forward_content = event.reply.message[0].data.get("content")
-        replyCombineForwardMessages = messageToSimple(forward_content)
+        # 对话内容构建成功后再发送等待提示, 系统提示词图片的渲染和发送与 LLM 调用并行进行
+        preview_task = asyncio.create_task(send_prompt_preview(event, system_prompt, prompt_filename))
 
-        # 使用换行符拼接并打印
-        usersChatText = json.dumps(replyCombineForwardMessages, ensure_ascii=False)
-        logger.info("=" * 25 + "对话内容" + "=" * 25)
-        logger.info(usersChatText)
-        logger.info("=" * 50)
         # 调用 LLM 获取评价
         try:
-            client = OpenAI(
-                api_key=plugin_config.openai_api_key,
-                base_url=plugin_config.openai_api_base
-            )
-
-            response = client.chat.completions.create(
-                model=plugin_config.openai_model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": usersChatText}
-                ]
+            # LLM 调用和结果渲染在各自函数内限制并发, 命中缓存时无需等待名额
+            _, llm_result = await asyncio.gather(
+                preview_task,
+                get_llm_result(system_prompt, usersChatText, use_cache="no-cache" not in flags)
             )
-
-            llm_result = response.choices[0].message.content
             logger.success(f"LLM 评价结果: {llm_result}")
 
             # 生成横屏和竖屏两种格式的图片
             # 构建消息
-            message = MessageSegment.reply(event.message_id)
-            message += MessageSegment.text(f"\n使用prompt文件: {prompt_filename}\n")
+            segments = [MessageSegment.reply(event.message_id), MessageSegment.text(f"\n使用prompt文件: {prompt_filename}\n")]
             try:
-                vertical_pic = await md_to_pic(md=llm_result, max_width=900, dpi=220, allow_refit=False, css_path=EMPTY_CSS_PATH)
-                message += MessageSegment.image(vertical_pic)
+                vertical_pic = await render_llm_result(md=llm_result, max_width=900, dpi=220, allow_refit=False, css_path=EMPTY_CSS_PATH)
+                segments.append(MessageSegment.image(vertical_pic))
             except Exception as pic_error:
                 logger.opt(exception=True).error(f"生成图片时发生错误: {pic_error}")
-                message += MessageSegment.text(llm_result)
-            await forward_ana_cmd.send(message=message)
+                segments.append(MessageSegment.text(llm_result))
+            await forward_ana_cmd.send(message=Message(segments))
 
         except Exception as llm_error:
             logger.opt(exception=True).error(f"调用 LLM 时发生错误: {llm_error}")
-            error_msg = MessageSegment.reply(event.message_id)
-            error_msg += MessageSegment.text(f"调用 LLM 时发生错误!")
-            await forward_ana_cmd.send(message=error_msg)
+            # 保证错误提示在系统提示词消息之后发送
+            await preview_task
+            await forward_ana_cmd.send(message=Message([
+                MessageSegment.reply(event.message_id),
+                _TIP_LLM_FAILED
+            ]))
     except Exception as e:
         logger.opt(exception=True).error(f"处理消息时发生错误: {e}")
     finally:
-        logger.info("=" * 50)
+        logger.info(_SEP)
 
 
-def messageToSimple(messages: list) -> list:
-    res = []
+def _iter_segments(messages: list):
+    """依次产出 (发送者昵称, 消息段)"""
+    return ((i["sender"]["nickname"], message) for i in messages for message in i["message"])
 
-    for i in messages:
-        upperSender = i["sender"]["nickname"]
-        for message in i["message"]:
+
+def messageToSimple(messages: list) -> str:
+    """将合并转发消息转换为文本, 每条消息一行, 嵌套的合并转发按层级缩进"""
+    lines = []
+    lines_append = lines.append
+    stack = [(_iter_segments(messages), "")]
+    stack_append = stack.append
+
+    while stack:
+        segments, indent = stack[-1]
+        for upperSender, message in segments:
             messageType = message["type"]
-            if messageType == "forward":
-                res.append([upperSender, "合并转发", messageToSimple(message["data"]["content"])])
+            # 文本消息最常见, 优先判断
             if messageType == "text":
-                res.append(f"{upperSender}: {message['data']['text']}")
-    return res
+                lines_append(f"{indent}{upperSender}: {message['data']['text']}")
+            elif messageType == "forward":
+                lines_append(f"{indent}{upperSender}: 合并转发")
+                # 先展开嵌套的合并转发, 结束后再继续当前层级
+                stack_append((_iter_segments(message["data"]["content"]), indent + "  "))
+                break
+        else:
+            stack.pop()
+    return "\n".join(lines)
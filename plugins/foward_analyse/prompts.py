@@ -4,10 +4,13 @@
 Prompts 管理模块
 负责加载和管理 prompt 模板文件
 """
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Dict
+from types import MappingProxyType
+from typing import Optional, Dict, Mapping
 from nonebot import logger
-import yaml
+import asyncio
+import os
 import re
 
 # 插件目录路径
@@ -18,8 +21,22 @@ SYSTEM_PROMPT_POV_PATH = PLUGIN_DIR / "prompts" / "pov.md"
 SYSTEM_PROMPT_BLANK_PATH = PLUGIN_DIR / "prompts" / "blank.md"
 EMPTY_CSS_PATH = PLUGIN_DIR / "empty.css"
 
-# 全局变量: alias -> 文件路径的映射字典
-PROMPT_ALIAS_MAP: Dict[str, str] = {}
+# 全局变量: alias -> 文件路径的只读映射, 通过 refresh_aliases() 整体替换
+PROMPT_ALIAS_MAP: Mapping[str, Path] = MappingProxyType({})
+
+# 缓存: 文件路径 -> (mtime, 去除 front matter 后的 prompt 内容)
+_prompt_cache: Dict[Path, tuple[float, str]] = {}
+# 缓存: 文件路径 -> (mtime, 文件原文)
+_prompt_file_cache: Dict[Path, tuple[float, str]] = {}
+# 缓存: (prompts 目录 mtime_ns, 排序后的 md 文件列表)
+_prompt_files_cache: Optional[tuple[int, list[Path]]] = None
+
+# 匹配 YAML front matter (以 --- 开头和结尾)
+_FRONT_MATTER_RE = re.compile(r'^---\s*\n(.*?)\n---\s*\n(.*)$', re.DOTALL)
+
+# 解析 alias 时只读取文件开头的字节数, 以及 front matter 结束标记
+_FRONT_MATTER_HEAD_SIZE = 4096
+_FRONT_MATTER_END_RE = re.compile(rb'\n---[ \t\r]*\n')
 
 # Trigger 配置
 triggers = {
@@ -42,6 +59,47 @@ triggers = {
 }
 
 
+def _build_trigger_tables() -> tuple[frozenset[str], Mapping[str, Path]]:
+    """
+    一次遍历 triggers, 同时生成命令名集合和命令到 prompt 文件路径的映射
+    命令名包括 key 和 aliases
+    """
+    names = []
+    command_map = {}
+    for trigger_key, trigger_config in triggers.items():
+        prompt_file_path = trigger_config["promptFilePath"]
+        for name in (trigger_key, *trigger_config["aliases"]):
+            names.append(name)
+            command_map[name] = prompt_file_path
+    return frozenset(names), MappingProxyType(command_map)
+
+
+# 所有命令名, 以及命令名 -> prompt 文件路径
+ALL_ALIASES, COMMAND_TO_PROMPT = _build_trigger_tables()
+
+
+def _parse_front_matter_text(content: str) -> tuple[Optional[dict], str]:
+    """
+    解析已读入的 Markdown 文本的 YAML front matter
+    返回: (front_matter_dict, content_without_front_matter)
+    """
+    # 不以 --- 开头的文件不可能有 front matter, 无需运行正则
+    if not content.startswith("---"):
+        return None, content
+
+    match = _FRONT_MATTER_RE.match(content)
+
+    if match:
+        yaml_content = match.group(1)
+        markdown_content = match.group(2)
+        # 仅在确实存在 front matter 时才导入 yaml
+        import yaml
+        front_matter = yaml.safe_load(yaml_content)
+        return front_matter, markdown_content
+    else:
+        return None, content
+
+
 def parse_yaml_front_matter(file_path: Path) -> tuple[Optional[dict], str]:
     """
     解析 Markdown 文件的 YAML front matter
@@ -50,28 +108,43 @@ def parse_yaml_front_matter(file_path: Path) -> tuple[Optional[dict], str]:
     try:
         with open(file_path, "r", encoding="utf-8") as f:
             content = f.read()
-        
-        # 匹配 YAML front matter (以 --- 开头和结尾)
-        pattern = r'^---\s*\n(.*?)\n---\s*\n(.*)$'
-        match = re.match(pattern, content, re.DOTALL)
-        
-        if match:
-            yaml_content = match.group(1)
-            markdown_content = match.group(2)
-            front_matter = yaml.safe_load(yaml_content)
-            return front_matter, markdown_content
-        else:
-            return None, content
+        return _parse_front_matter_text(content)
     except Exception as e:
         logger.opt(exception=True).error(f"解析 YAML front matter 失败 ({file_path.name}): {e}")
         return None, ""
 
 
-def load_prompt_aliases() -> Dict[str, str]:
+def _parse_one_prompt(md_file: Path) -> Optional[dict]:
+    """
+    只读取 prompt 文件开头部分并解析 front matter
+    front matter 总在文件开头, 通常无需读取整个文件
+    """
+    try:
+        with open(md_file, "rb") as f:
+            head = f.read(_FRONT_MATTER_HEAD_SIZE)
+            if not head.startswith(b"---"):
+                return None
+            # front matter 超出已读取的部分时, 读完整个文件
+            if _FRONT_MATTER_END_RE.search(head) is None:
+                head += f.read()
+        front_matter, _ = _parse_front_matter_text(head.decode("utf-8", errors="ignore"))
+        return front_matter
+    except Exception as e:
+        logger.opt(exception=True).error(f"解析 YAML front matter 失败 ({md_file.name}): {e}")
+        return None
+
+
+def _scan_prompt_files(prompts_dir: Path) -> list[Path]:
+    """用 os.scandir 列出目录下的 md 文件, 按文件名排序"""
+    with os.scandir(prompts_dir) as it:
+        return sorted(Path(entry.path) for entry in it if entry.name.endswith(".md") and entry.is_file())
+
+
+def load_prompt_aliases() -> Dict[str, Path]:
     """
     加载所有 prompt 文件,构建 alias -> 文件路径的映射字典
     也包含文件名(带/不带.md后缀)作为key
-    返回: {alias: file_path_str}
+    返回: {alias: file_path}
     """
     alias_map = {}
     prompts_dir = PLUGIN_DIR / "prompts"
@@ -80,26 +153,32 @@ def load_prompt_aliases() -> Dict[str, str]:
         logger.warning(f"prompts 目录不存在: {prompts_dir}")
         return alias_map
     
-    md_files = sorted(prompts_dir.glob("*.md"))
-    for md_file in md_files:
+    md_files = _scan_prompt_files(prompts_dir)
+    if not md_files:
+        logger.warning(f"prompts 目录下没有 prompt 文件: {prompts_dir}")
+        return alias_map
+
+    # 用线程池并发读取并解析各文件的 front matter, 再按文件顺序依次注册
+    with ThreadPoolExecutor(max_workers=min(8, len(md_files))) as executor:
+        front_matters = list(executor.map(_parse_one_prompt, md_files))
+
+    for md_file, front_matter in zip(md_files, front_matters):
         try:
-            file_path_str = str(md_file)
             file_name_with_ext = md_file.name
             file_name_without_ext = md_file.stem
 
             # 注册文件名 (带和不带后缀)
-            alias_map[file_name_with_ext] = file_path_str
-            alias_map[file_name_without_ext] = file_path_str
+            alias_map[file_name_with_ext] = md_file
+            alias_map[file_name_without_ext] = md_file
             logger.info(f"注册文件名: '{file_name_with_ext}' & '{file_name_without_ext}' -> {file_name_with_ext}")
 
-            # 解析并注册 YAML front matter 中的 alias
-            front_matter, _ = parse_yaml_front_matter(md_file)
+            # 注册 YAML front matter 中的 alias
             if front_matter and "alias" in front_matter:
                 aliases = front_matter["alias"]
                 if isinstance(aliases, list):
                     for alias in aliases:
                         if isinstance(alias, str):
-                            alias_map[alias] = file_path_str
+                            alias_map[alias] = md_file
                             logger.info(f"注册 YAML alias: '{alias}' -> {md_file.name}")
         except Exception as e:
             logger.opt(exception=True).error(f"处理文件 {md_file.name} 时出错: {e}")
@@ -110,29 +189,64 @@ def load_prompt_aliases() -> Dict[str, str]:
 
 def load_system_prompt() -> str:
     """加载系统 prompt"""
-    try:
-        with open(SYSTEM_PROMPT_JUSTICE_PATH, "r", encoding="utf-8") as f:
-            content = f.read()
-        # 移除 YAML front matter 后返回
-        _, markdown_content = parse_yaml_front_matter(SYSTEM_PROMPT_JUSTICE_PATH)
-        return markdown_content if markdown_content else content
-    except Exception as e:
-        logger.opt(exception=True).error(f"警告: 无法读取 prompt 模板文件: {e}")
-        return """你是一个公正的裁判,请客观地评价对话内容。"""
+    return load_prompt_content(SYSTEM_PROMPT_JUSTICE_PATH)
 
 
 def load_prompt_content(path: Path) -> str:
-    """从指定路径加载并解析 prompt 内容"""
+    """从指定路径加载并解析 prompt 内容, 文件 mtime 未变化时直接返回缓存"""
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            content = f.read()
+        mtime = path.stat().st_mtime
+        cached = _prompt_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        content = read_prompt_file(path)
         # 移除 YAML front matter 后返回
-        _, markdown_content = parse_yaml_front_matter(path)
-        return markdown_content if markdown_content else content
+        _, markdown_content = _parse_front_matter_text(content)
+        result = markdown_content if markdown_content else content
+        _prompt_cache[path] = (mtime, result)
+        return result
     except Exception as e:
         logger.opt(exception=True).error(f"警告: 无法读取 prompt 模板文件({path.name}): {e}")
         return """你是一个公正的裁判,请客观地评价对话内容。"""
 
 
+async def load_prompt_content_async(path: Path) -> str:
+    """在线程中执行 load_prompt_content, 避免文件读取阻塞事件循环"""
+    return await asyncio.to_thread(load_prompt_content, path)
+
+
+def list_prompt_files() -> list[Path]:
+    """列出 prompts 目录下所有 md 文件, 目录 mtime 未变化时直接返回缓存"""
+    global _prompt_files_cache
+    prompts_dir = PLUGIN_DIR / "prompts"
+    mtime_ns = prompts_dir.stat().st_mtime_ns
+    if _prompt_files_cache and _prompt_files_cache[0] == mtime_ns:
+        return _prompt_files_cache[1]
+
+    md_files = _scan_prompt_files(prompts_dir)
+    _prompt_files_cache = (mtime_ns, md_files)
+    return md_files
+
+
+def read_prompt_file(path: Path) -> str:
+    """读取 prompt 文件原文 (包含 front matter), 文件 mtime 未变化时直接返回缓存"""
+    mtime = path.stat().st_mtime
+    cached = _prompt_file_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    content = path.read_text(encoding="utf-8")
+    _prompt_file_cache[path] = (mtime, content)
+    return content
+
+
+def refresh_aliases() -> Mapping[str, Path]:
+    """重新扫描 prompt 文件并整体替换 PROMPT_ALIAS_MAP"""
+    global PROMPT_ALIAS_MAP
+    PROMPT_ALIAS_MAP = MappingProxyType(load_prompt_aliases())
+    return PROMPT_ALIAS_MAP
+
+
 # 在模块加载时构建 alias 映射
-PROMPT_ALIAS_MAP = load_prompt_aliases()
+refresh_aliases()